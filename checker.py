@@ -1,41 +1,176 @@
 import argparse
-import json
+from concurrent.futures import ProcessPoolExecutor
+import functools
 from pathlib import Path
 import subprocess
 import sys
 import typeshed_client
 from typed_ast import ast3
-from typing import Any, Dict, Iterator, NamedTuple, Tuple
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json  # type: ignore
 
 RuntimeDict = Dict[str, Any]
 
+# Below this many modules, starting a process pool costs more than it saves.
+_MIN_MODULES_FOR_POOL = 16
+
 
 class Error(NamedTuple):
     module_name: str
     message: str
 
 
-def get_defined_names(module_name: str, python_version: Tuple[int, int]) -> RuntimeDict:
-    """Invokes find_names.py to get names defined in a module."""
-    python_binary = f'python{python_version[0]}.{python_version[1]}'
-    output = subprocess.check_output([python_binary, 'find_names.py', module_name])
-    return json.loads(output)[module_name]
+class FindNamesError(Exception):
+    pass
+
+
+class FindNamesClient:
+    """Gets names defined in modules from a long-lived find_names.py process.
+
+    The process is started on first use and restarted if it dies, for example because
+    importing a module crashed the interpreter.
+    """
+
+    def __init__(self, python_version: Tuple[int, int]) -> None:
+        self.python_version = python_version
+        self._process: Optional[subprocess.Popen] = None
+
+    def __enter__(self) -> 'FindNamesClient':
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
+
+    def get_defined_names(self, module_name: str) -> RuntimeDict:
+        """Invokes find_names.py to get names defined in a module."""
+        process = self._get_process()
+        try:
+            process.stdin.write(f'{module_name}\n'.encode())
+            process.stdin.flush()
+            line = process.stdout.readline()
+        except BrokenPipeError:
+            line = b''
+        if not line:
+            self.close()
+            raise FindNamesError(f'find_names.py exited while importing {module_name}')
+        try:
+            response = _json.loads(line)
+        except ValueError:
+            # Something else wrote to the server's stdout, so the stream can't be trusted.
+            process.kill()
+            self.close()
+            raise FindNamesError(f'find_names.py returned invalid output for {module_name}')
+        if 'error' in response:
+            raise FindNamesError(response['error'])
+        return response['names']
+
+    def close(self) -> None:
+        if self._process is None:
+            return
+        try:
+            # This flushes any request left in the buffer, which fails if the process is gone.
+            self._process.stdin.close()
+        except OSError:
+            pass
+        finally:
+            self._process.wait()
+            self._process = None
+
+    def _get_process(self) -> subprocess.Popen:
+        if self._process is None:
+            self._process = subprocess.Popen(
+                [_get_python_binary(self.python_version), 'find_names.py', '--server'],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        return self._process
+
+
+def _get_python_binary(python_version: Tuple[int, int]) -> str:
+    return f'python{python_version[0]}.{python_version[1]}'
+
+
+def get_all_defined_names(module_names: Sequence[str], python_version: Tuple[int, int]
+                          ) -> Tuple[Dict[str, RuntimeDict], Dict[str, str]]:
+    """Invokes find_names.py once to get names defined in all the given modules.
+
+    Returns the names for each module that could be imported, and the error for each module
+    that could not. Where os.fork is available, find_names.py imports each module in its own
+    forked child, so modules do not see each other's imports. Without fork, submodules imported
+    by one module can show up as attributes of another module's package. If the batch process itself dies (for example, because importing a module
+    crashed the interpreter), each module is retried on its own through a FindNamesClient.
+    """
+    try:
+        output = subprocess.check_output(
+            [_get_python_binary(python_version), 'find_names.py', *module_names])
+        # Split on b'\n' only; names may contain other characters that splitlines() breaks on.
+        responses = [_json.loads(line) for line in output.split(b'\n')[:-1]]
+    except (subprocess.CalledProcessError, ValueError):
+        responses = []
+    if len(responses) != len(module_names):
+        return _get_defined_names_one_by_one(module_names, python_version)
+    runtimes = {}
+    import_errors = {}
+    for module_name, response in zip(module_names, responses):
+        if 'error' in response:
+            import_errors[module_name] = response['error']
+        else:
+            runtimes[module_name] = response['names']
+    return runtimes, import_errors
+
+
+def _get_defined_names_one_by_one(module_names: Sequence[str], python_version: Tuple[int, int]
+                                  ) -> Tuple[Dict[str, RuntimeDict], Dict[str, str]]:
+    runtimes = {}
+    import_errors = {}
+    with FindNamesClient(python_version) as client:
+        for module_name in module_names:
+            try:
+                runtimes[module_name] = client.get_defined_names(module_name)
+            except FindNamesError as e:
+                import_errors[module_name] = str(e)
+    return runtimes, import_errors
 
 
-def get_stub_names(module_name: str, python_version: Tuple[int, int],
-                   typeshed_dir: Path) -> typeshed_client.NameDict:
+def get_search_context(python_version: Tuple[int, int], typeshed_dir: Path,
+                       search_path: Optional[Sequence[Path]] = None
+                       ) -> Optional['typeshed_client.SearchContext']:
+    """Returns a search context to share across modules, if typeshed_client supports them.
+
+    typeshed_dir may be a typeshed checkout, as older versions of typeshed_client expect, or
+    its stdlib directory. If search_path is not given, the sys.path of the python{X}.{Y}
+    interpreter being checked is used.
+    """
+    if not hasattr(typeshed_client, 'get_search_context'):
+        return None
+    # Search contexts point at the stdlib directory, not the root of the checkout.
+    if (typeshed_dir / 'stdlib' / 'VERSIONS').exists():
+        typeshed_dir = typeshed_dir / 'stdlib'
+    if search_path is None:
+        return typeshed_client.get_search_context(
+            version=python_version, typeshed=typeshed_dir,
+            python_executable=_get_python_binary(python_version))
+    return typeshed_client.get_search_context(version=python_version, typeshed=typeshed_dir,
+                                              search_path=search_path)
+
+
+def get_stub_names(module_name: str, python_version: Tuple[int, int], typeshed_dir: Path,
+                   search_context: Optional['typeshed_client.SearchContext'] = None
+                   ) -> typeshed_client.NameDict:
+    if search_context is not None:
+        return typeshed_client.get_stub_names(module_name, search_context=search_context)
     return typeshed_client.get_stub_names(module_name, version=python_version,
                                           typeshed_dir=typeshed_dir)
 
 
-def check_module(module_name: str, python_version: Tuple[int, int],
-                 typeshed_dir: Path) -> Iterator[Error]:
-    try:
-        runtime = get_defined_names(module_name, python_version)
-    except subprocess.CalledProcessError:
-        print(f'failed to import {module_name}')
-        return
-    stub = get_stub_names(module_name, python_version=python_version, typeshed_dir=typeshed_dir)
+def check_module(module_name: str, runtime: RuntimeDict, python_version: Tuple[int, int],
+                 typeshed_dir: Path,
+                 search_context: Optional['typeshed_client.SearchContext'] = None
+                 ) -> Iterator[Error]:
+    stub = get_stub_names(module_name, python_version=python_version, typeshed_dir=typeshed_dir,
+                          search_context=search_context)
 
     yield from check_only_in_stub(runtime, stub, module_name)
     yield from check_only_in_runtime(runtime, stub, module_name)
@@ -43,7 +178,7 @@ def check_module(module_name: str, python_version: Tuple[int, int],
 
 def check_only_in_stub(runtime: RuntimeDict, stub: typeshed_client.NameDict,
                        module_name: str) -> Iterator[Error]:
-    for name, info in sorted(stub.items()):
+    for name, info in stub.items():
         if name in runtime:
             continue
         if not info.is_exported:
@@ -65,17 +200,52 @@ def check_only_in_stub(runtime: RuntimeDict, stub: typeshed_client.NameDict,
 def check_only_in_runtime(runtime: RuntimeDict, stub: typeshed_client.NameDict,
                           module_name: str) -> Iterator[Error]:
     if '__all__' in runtime:
-        for name in sorted(runtime['__all__']['value']):
+        for name in runtime['__all__']['value']:
             if name not in stub:
                 yield Error(module_name, f'{name!r} is in __all__ but not in stub')
     else:
         ...
 
 
-def run_on(module_name: str, python_version: Tuple[int, int],
-           typeshed_dir: Path) -> None:
-    for error in check_module(module_name, python_version, typeshed_dir):
-        print(f'{error.module_name}: {error.message}')
+def _check_module_errors(module_name: str, runtime: RuntimeDict, python_version: Tuple[int, int],
+                         typeshed_dir: Path,
+                         search_context: Optional['typeshed_client.SearchContext']
+                         ) -> List[Error]:
+    errors = list(check_module(module_name, runtime, python_version, typeshed_dir,
+                               search_context))
+    # Sort only the errors rather than every name, so output stays deterministic.
+    errors.sort(key=lambda error: error.message)
+    return errors
+
+
+def run_on(module_names: Sequence[str], runtimes: Dict[str, RuntimeDict],
+           import_errors: Dict[str, str], python_version: Tuple[int, int], typeshed_dir: Path,
+           search_context: Optional['typeshed_client.SearchContext'] = None) -> None:
+    """Checks the given modules.
+
+    Large runs parse the stubs in a pool of worker processes. Each worker then has its own
+    typeshed_client caches.
+    """
+    imported = [module_name for module_name in module_names if module_name in runtimes]
+    check = functools.partial(_check_module_errors, python_version=python_version,
+                              typeshed_dir=typeshed_dir, search_context=search_context)
+    runtime_list = [runtimes[module_name] for module_name in imported]
+    if len(imported) < _MIN_MODULES_FOR_POOL:
+        _print_errors(module_names, import_errors, map(check, imported, runtime_list))
+    else:
+        with ProcessPoolExecutor() as executor:
+            _print_errors(module_names, import_errors,
+                          executor.map(check, imported, runtime_list, chunksize=8))
+
+
+def _print_errors(module_names: Sequence[str], import_errors: Dict[str, str],
+                  all_errors: Iterator[List[Error]]) -> None:
+    for module_name in module_names:
+        if module_name in import_errors:
+            print(f'failed to import {module_name}: {import_errors[module_name]}')
+            continue
+        for error in next(all_errors):
+            print(f'{error.module_name}: {error.message}')
 
 
 if __name__ == '__main__':
@@ -95,9 +265,20 @@ if __name__ == '__main__':
     else:
         version = tuple(map(int, args.python_version.split('.', 1)))
     if args.stdlib:
-        for module_name, path in typeshed_client.get_all_stub_files(version, typeshed_dir):
-            if 'third_party' not in path.parts:
-                run_on(module_name, version, typeshed_dir)
+        # With an empty search path, stubs are listed and resolved only from typeshed's stdlib,
+        # never from stubs installed in site-packages (such as typeshed_client's bundled copy).
+        search_context = get_search_context(version, typeshed_dir, search_path=[])
+        if search_context is not None:
+            stub_files = typeshed_client.get_all_stub_files(search_context)
+        else:
+            stub_files = typeshed_client.get_all_stub_files(version, typeshed_dir)
+        module_names = [
+            module_name
+            for module_name, path in stub_files
+            if 'third_party' not in path.parts
+        ]
     else:
-        for module_name in args.modules:
-            run_on(module_name, version, typeshed_dir)
+        search_context = get_search_context(version, typeshed_dir)
+        module_names = args.modules
+    runtimes, import_errors = get_all_defined_names(module_names, version)
+    run_on(module_names, runtimes, import_errors, version, typeshed_dir, search_context)
@@ -1,10 +1,31 @@
-"""Script to find the names defined in a module and dump them as JSON."""
+"""Script to find the names defined in modules and dump them as JSON.
+
+For each module, a single line of JSON is written to stdout, holding either the names or the
+error that prevented importing the module. Modules are taken from the command line, or with
+--server read one per line from stdin.
+"""
 
-import inspect2
 import json
-import six
+import os
 import sys
 
+if sys.version_info[0] >= 3:
+    import inspect
+    integer_types = (int,)
+    string_types = (str,)
+    class_types = (type,)
+else:
+    import inspect2 as inspect
+    import six
+    integer_types = six.integer_types
+    string_types = six.string_types
+    class_types = six.class_types
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 def get_fully_qualified_name(obj):
     return '{}.{}'.format(obj.__module__, obj.__name__)
@@ -19,31 +40,41 @@ def import_module(name):
 
 def handle_module(name):
     mod = import_module(name)
+    getmodule = inspect.getmodule
+    signature = inspect.signature
+    scalar_types = integer_types + string_types + (float,)
     output = {}
     for name in dir(mod):
+        # Other dunders (__doc__, __spec__, ...) are not useful for checking stubs, and fetching
+        # them may trigger module-level __getattr__ hooks.
+        if name.startswith('__') and name != '__all__':
+            continue
         raw_value = getattr(mod, name)
+        # getmodule() may scan all of sys.modules, so only call it where the answer is useful.
+        module = None
         if name == '__all__':
             typ = '__all__'
             value = list(raw_value)
-        elif raw_value is None or isinstance(raw_value, (six.integer_types, six.string_types, float)):
+        elif raw_value is None or isinstance(raw_value, scalar_types):
             typ = 'scalar'
             value = type(raw_value).__name__
-        elif isinstance(raw_value, six.class_types):
+        elif isinstance(raw_value, class_types):
             typ = 'class'
             value = {
                 'fully_qualified_name': get_fully_qualified_name(raw_value),
             }
-        elif six.callable(raw_value):
+            module = getmodule(raw_value)
+        elif callable(raw_value):
             typ = 'callable'
             try:
-                sig = inspect2.signature(raw_value)
-            except ValueError:
+                sig = signature(raw_value)
+            except (ValueError, TypeError):
                 sig = None
             value = str(sig)
+            module = getmodule(raw_value)
         else:
             typ = 'other'
             value = type(raw_value).__name__
-        module = inspect2.getmodule(raw_value)
         output[name] = {
             'type': typ,
             'value': value,
@@ -53,6 +84,77 @@ def handle_module(name):
     return output
 
 
+def dumps(data):
+    """Returns data as a line of JSON, encoded as bytes.
+
+    orjson does not escape characters such as U+2028 that str.splitlines() treats as line
+    breaks, so readers must split the output on newline bytes only.
+    """
+    if orjson is not None:
+        return orjson.dumps(data) + b'\n'
+    output = json.dumps(data)
+    if not isinstance(output, bytes):
+        output = output.encode('ascii')
+    return output + b'\n'
+
+
+def get_response(name):
+    """Returns the response line for a module, handling it in a forked child if possible.
+
+    Each module is imported in a fresh copy of this process, so it does not see attributes
+    left behind by other modules in the same run (such as submodules that an earlier module
+    imported and that were set on their parent package). A crash while importing only takes
+    down the child.
+    """
+    if not hasattr(os, 'fork'):
+        return _get_response(name)
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        exit_code = 1
+        try:
+            os.close(read_fd)
+            # Send anything written directly to file descriptor 1 to stderr too.
+            os.dup2(2, 1)
+            with os.fdopen(write_fd, 'wb') as f:
+                f.write(_get_response(name))
+            exit_code = 0
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(exit_code)
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as f:
+        response = f.read()
+    _, status = os.waitpid(pid, 0)
+    if not response:
+        if os.WIFSIGNALED(status):
+            reason = 'was killed by signal {}'.format(os.WTERMSIG(status))
+        else:
+            reason = 'exited with status {}'.format(os.WEXITSTATUS(status))
+        return dumps({'error': 'child process {} without a response'.format(reason)})
+    return response
+
+
+def _get_response(name):
+    try:
+        return dumps({'names': handle_module(name)})
+    except Exception as e:
+        return dumps({'error': '{}: {}'.format(type(e).__name__, e)})
+
+
+def serve(out):
+    for line in iter(sys.stdin.readline, ''):
+        out.write(get_response(line.strip()))
+        out.flush()
+
+
 if __name__ == '__main__':
-    data = {name: handle_module(name) for name in sys.argv[1:]}
-    json.dump(data, sys.stdout)
+    # Keep output from imported modules from corrupting our own output.
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    sys.stdout = sys.stderr
+    if sys.argv[1:] == ['--server']:
+        serve(out)
+    else:
+        for name in sys.argv[1:]:
+            out.write(get_response(name))